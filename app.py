@@ -7,6 +7,19 @@ from rag_pipeline import create_qa_chain, generate_questions, get_available_pdfs
 
 load_dotenv()
 
+
+@st.cache_data(ttl=30, show_spinner=False)
+def list_pdfs():
+    """Scan data/samples/ at most every 30s instead of on every rerun"""
+    return [str(p) for p in get_available_pdfs()]
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def pdf_size_kb(pdf_path: str) -> float:
+    """File size shown on the sidebar PDF card"""
+    return os.path.getsize(pdf_path) / 1024
+
+
 # ── Page Config ────────────────────────────────────────────────────────────────
 st.set_page_config(
     page_title="AcademIQ — Research Paper Assistant",
@@ -314,6 +327,8 @@ if "selected_pdf" not in st.session_state:
     st.session_state.selected_pdf = None
 if "qa_chain" not in st.session_state:
     st.session_state.qa_chain = None
+if "selected_path" not in st.session_state:
+    st.session_state.selected_path = None
 
 
 # ── Sidebar ────────────────────────────────────────────────────────────────────
@@ -331,7 +346,7 @@ with st.sidebar:
 
     st.markdown('<div class="section-label">📂 Select Paper</div>', unsafe_allow_html=True)
 
-    pdfs = get_available_pdfs()
+    pdfs = list_pdfs()
 
     if not pdfs:
         st.warning("No PDFs found in data/samples/")
@@ -347,7 +362,7 @@ with st.sidebar:
         selected_path = pdfs[pdf_names.index(selected_name)]
 
         # Show PDF info card
-        file_size = os.path.getsize(selected_path) / 1024
+        file_size = pdf_size_kb(selected_path)
         st.markdown(f"""
         <div class="pdf-info-card">
             <div class="pdf-name">📄 {selected_name}</div>
@@ -360,6 +375,7 @@ with st.sidebar:
                 try:
                     st.session_state.qa_chain = create_qa_chain(selected_path)
                     st.session_state.selected_pdf = selected_name
+                    st.session_state.selected_path = selected_path
                     st.session_state.chat_history = []
                     st.success(f"✅ Loaded successfully!")
                 except Exception as e:
@@ -432,38 +448,45 @@ with tab1:
         elif not query.strip():
             st.warning("⚠️ Please enter a question.")
         else:
-            with st.spinner("Analysing paper..."):
-                try:
-                    result = st.session_state.qa_chain.invoke({"input": query})
-                    answer = result["answer"]
-
-                    # Get source documents
-                    sources = result.get("context", [])
-                    source_pages = list(set([
-                        f"Page {doc.metadata.get('page', '?') + 1}"
-                        for doc in sources
-                        if hasattr(doc, 'metadata')
-                    ]))
-
-                    # Save to history
-                    st.session_state.chat_history.append({
-                        "question": query,
-                        "answer": answer,
-                        "sources": source_pages
-                    })
-
-                    # Display answer
-                    st.markdown('<div class="section-label" style="margin-top:24px;">Answer</div>', unsafe_allow_html=True)
-                    st.markdown(f'<div class="answer-card">{answer}</div>', unsafe_allow_html=True)
-
-                    # Show sources
-                    if source_pages:
-                        st.markdown('<div class="section-label" style="margin-top:16px;">Sources</div>', unsafe_allow_html=True)
-                        badges = "".join([f'<span class="source-badge">📄 {p}</span>' for p in source_pages])
-                        st.markdown(f'<div>{badges}</div>', unsafe_allow_html=True)
-
-                except Exception as e:
-                    st.error(f"❌ Error: {e}")
+            try:
+                st.markdown('<div class="section-label" style="margin-top:24px;">Answer</div>', unsafe_allow_html=True)
+                answer_box = st.empty()
+
+                # Stream tokens into the answer card as they arrive
+                answer = ""
+                sources = []
+                with st.spinner("Analysing paper..."):
+                    for chunk in st.session_state.qa_chain.stream({"input": query}):
+                        if "context" in chunk:
+                            sources = chunk["context"]
+                        if "answer" in chunk:
+                            answer += chunk["answer"]
+                            answer_box.markdown(f'<div class="answer-card">{answer}▌</div>', unsafe_allow_html=True)
+                answer_box.markdown(f'<div class="answer-card">{answer}</div>', unsafe_allow_html=True)
+
+                # Get source documents
+                # Ordered dedup keeps the retriever's most-relevant-first order
+                source_pages = list(dict.fromkeys(
+                    f"Page {doc.metadata.get('page', '?') + 1}"
+                    for doc in sources
+                    if hasattr(doc, 'metadata')
+                ))
+
+                # Save to history
+                st.session_state.chat_history.append({
+                    "question": query,
+                    "answer": answer,
+                    "sources": source_pages
+                })
+
+                # Show sources
+                if source_pages:
+                    st.markdown('<div class="section-label" style="margin-top:16px;">Sources</div>', unsafe_allow_html=True)
+                    badges = "".join([f'<span class="source-badge">📄 {p}</span>' for p in source_pages])
+                    st.markdown(f'<div>{badges}</div>', unsafe_allow_html=True)
+
+            except Exception as e:
+                st.error(f"❌ Error: {e}")
 
     # Show full chat history
     if st.session_state.chat_history:
@@ -512,7 +535,7 @@ with tab2:
             with st.spinner(f"Generating {q_count} {q_type} questions..."):
                 try:
                     questions = generate_questions(
-                        st.session_state.qa_chain,
+                        st.session_state.selected_path,
                         q_type=q_type,
                         count=q_count,
                         topic=topic_hint
@@ -1,73 +1,24 @@
-import os
-from pathlib import Path
+from rag_pipeline import DATA_DIR, build_all_vectorstores, get_available_pdfs
 
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-
-
-# Paths
-DATA_DIR = "data/samples"
-DB_DIR = "vectorstore"
-
-
-def load_pdfs(data_dir):
-    documents = []
+def main():
+    print("🚀 Starting ingestion pipeline...")
 
-    pdf_files = list(Path(data_dir).glob("*.pdf"))
+    pdf_files = get_available_pdfs()
 
     if not pdf_files:
-        raise ValueError("❌ No PDF files found in data/samples/")
+        raise ValueError(f"❌ No PDF files found in {DATA_DIR}/")
 
     print(f"📄 Found {len(pdf_files)} PDF files")
 
-    for pdf in pdf_files:
-        print(f"➡️ Loading: {pdf.name}")
-        loader = PyPDFLoader(str(pdf))
-        docs = loader.load()
-        documents.extend(docs)
-
-    return documents
-
-
-def split_documents(documents):
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-
-    chunks = splitter.split_documents(documents)
-
-    print(f"✂️ Created {len(chunks)} text chunks")
-
-    return chunks
-
-
-def create_vectorstore(chunks):
-    print("🔢 Creating embeddings...")
-
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
-    )
-
-    db = FAISS.from_documents(chunks, embeddings)
-
-    db.save_local(DB_DIR)
-
-    print(f"✅ Vector store saved in: {DB_DIR}/")
-
-
-def main():
-    print("🚀 Starting ingestion pipeline...")
-
-    docs = load_pdfs(DATA_DIR)
-
-    chunks = split_documents(docs)
+    # Same per-paper layout the app loads from: vectorstore/<pdf-name>/
+    # Papers that already have an index are skipped; the rest build in parallel
+    built = build_all_vectorstores()
 
-    create_vectorstore(chunks)
+    for vs_path in built:
+        print(f"✅ Vector store saved in: {vs_path}/")
 
+    print(f"⏭️ {len(pdf_files) - len(built)} already built")
     print("🎉 Ingestion completed successfully!")
 
 
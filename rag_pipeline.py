@@ -1,29 +1,322 @@
+import asyncio
+import hashlib
+import multiprocessing
 import os
-import json
+import pickle
 import re
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, nullcontext
+from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 
+import faiss
+import httpx
+import numpy as np
+import orjson
+import pymupdf
+import torch
+from pydantic import BaseModel, ValidationError
+from transformers import AutoTokenizer
+
 from langchain_groq import ChatGroq
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.cross_encoders import HuggingFaceCrossEncoder
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain.retrievers.document_compressors import CrossEncoderReranker
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.retrievers import BaseRetriever
 
 load_dotenv()
 
 DATA_DIR = "data/samples"
 VECTOR_DB_BASE = "vectorstore"
 
+# Resolved once at import; ingestion works without a key, so a missing
+# key is only reported when an LLM call is actually requested
+_GROQ_KEY = os.getenv("GROQ_API_KEY")
+_DATA_DIR = Path(DATA_DIR)
+
+# HNSW graph parameters (neighbours per node, build / query beam width)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Long papers (a few hundred pages) get an IVF index over fp16 codes instead;
+# from IVFPQ_MIN_VECTORS there are enough points to train 256-centroid PQ
+# codebooks, so very long documents use 48 sub-quantizers of 8 bits
+IVF_MIN_VECTORS = 1_000
+IVFPQ_MIN_VECTORS = 10_000
+IVFPQ_M = 48
+
+# With USE_GPU_INDEX=1, indexes at least this large are cloned onto the GPU
+# (IVF indexes, which are the ones with a GPU implementation)
+GPU_INDEX_MIN_VECTORS = IVF_MIN_VECTORS
+
+# Split points tried in order: section headings first ("3 Method",
+# "4.2 Results", "ABSTRACT" ...), then paragraphs, lines, sentences, words
+_SECTION_SEPARATORS = [
+    r"\n(?=\d+(?:\.\d+)*\.?[ \t]+[A-Z][^\n]{0,80}\n)",
+    r"\n(?=(?i:abstract|introduction|related work|background|methods?|methodology"
+    r"|experiments?|results|discussion|conclusions?|references|acknowledge?ments)[ \t]*\n)",
+    r"\n\n",
+    r"\n",
+    r"\. ",
+    r" ",
+    r"",
+]
+
+# Loaded FAISS indexes, keyed by vectorstore path
+_VECTORSTORES = {}
+
+# Retrieved question-generation context, keyed by (vectorstore path, query),
+# least recently used first; filled from asyncio.to_thread workers
+QUESTION_CONTEXT_CACHE_SIZE = 32
+_QUESTION_CONTEXT_CACHE = OrderedDict()
+_QUESTION_CONTEXT_LOCK = threading.Lock()
+
+# Groq settings shared by the sync and async clients
+_LLM_KWARGS = {"model": "llama-3.1-8b-instant", "temperature": 0}
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=8)
+
+# Chunks are embedded on a background thread while the main thread keeps
+# parsing pages; torch releases the GIL during the forward pass
+_EMBED_POOL = ThreadPoolExecutor(max_workers=1)
+EMBED_BATCH_SIZE = 256
+
+# Pages are split concurrently. Token counting is the bulk of splitter time
+# and runs in Rust: tiktoken for parent sections (GIL released) and MiniLM's
+# fast tokenizer for child windows
+SPLIT_WORKERS = 4
+_SPLIT_POOL = ThreadPoolExecutor(max_workers=SPLIT_WORKERS)
+
+# Child-window splitters, one per splitting thread
+_CHILD_SPLITTERS = threading.local()
+
+# Intra-op threads per build worker process, set by _init_build_worker;
+# None outside the pool (torch and ONNX Runtime then use every core)
+_WORKER_THREADS = None
+
 
 # ── Helpers ────────────────────────────────────────────────────────────────────
 
 def get_available_pdfs():
     """Return list of PDF paths in data/samples/"""
-    return sorted(Path(DATA_DIR).glob("*.pdf"))
+    return sorted(_DATA_DIR.glob("*.pdf"))
+
+
+def _embedding_model_kwargs() -> dict:
+    """Model settings that decide the vectors MiniLM produces (device,
+    backend, weights file, dtype); also part of the embedding cache key"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_kwargs = {"device": device}
+
+    # On CPU run the ONNX export through ONNX Runtime's fused kernels instead
+    # of PyTorch eager; EMBEDDINGS_INT8=1 in .env opts into the int8 model
+    if device == "cpu":
+        model_kwargs["backend"] = "onnx"
+        if os.getenv("EMBEDDINGS_INT8") == "1":
+            model_kwargs["model_kwargs"] = {
+                "file_name": "onnx/model_qint8_avx512_vnni.onnx"
+            }
+    else:
+        # Half-precision weights run on the GPU's tensor cores
+        model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+
+    return model_kwargs
+
+
+@lru_cache(maxsize=1)
+def _get_embeddings():
+    """Load the MiniLM embedding model once per process and reuse it"""
+    model_kwargs = _embedding_model_kwargs()
+
+    # Inside a build worker, keep ONNX Runtime to the worker's share of cores
+    if _WORKER_THREADS and model_kwargs.get("backend") == "onnx":
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = _WORKER_THREADS
+        options.inter_op_num_threads = 1
+        model_kwargs.setdefault("model_kwargs", {})["session_options"] = options
+
+    return HuggingFaceEmbeddings(
+        model_name="sentence-transformers/all-MiniLM-L6-v2",
+        model_kwargs=model_kwargs,
+        encode_kwargs={
+            "batch_size": 128,
+            "normalize_embeddings": True,
+            "convert_to_numpy": True
+        }
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_splitter():
+    """Heading-aware splitter producing the parent sections handed to the LLM"""
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base",
+        chunk_size=256,
+        chunk_overlap=32,
+        separators=_SECTION_SEPARATORS,
+        is_separator_regex=True
+    )
+
+
+def _get_child_splitter():
+    """Sliding window producing the chunks that get embedded, measured with
+    MiniLM's own tokenizer: 128 word pieces, about half a parent section, so
+    matching is finer than the context handed to the LLM and always fits
+    MiniLM's 256 limit. One per thread, since a fast tokenizer instance isn't
+    safe to share."""
+    splitter = getattr(_CHILD_SPLITTERS, "splitter", None)
+    if splitter is None:
+        tokenizer = AutoTokenizer.from_pretrained("sentence-transformers/all-MiniLM-L6-v2")
+        splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+            tokenizer,
+            chunk_size=128,
+            chunk_overlap=32
+        )
+        _CHILD_SPLITTERS.splitter = splitter
+    return splitter
+
+
+def split_into_parents_and_children(docs):
+    """Split pages into parent sections, then each section into child windows
+    that carry a parent_id back to the section they came from"""
+    parents = _get_splitter().split_documents(docs)
+
+    # Ids are scoped by page so pages can be split independently
+    for i, parent in enumerate(parents):
+        parent.metadata["parent_id"] = f"parent-{parent.metadata.get('page', 0)}-{i}"
+
+    # Children inherit parent_id through the copied metadata
+    children = _get_child_splitter().split_documents(parents)
+
+    return parents, children
+
+
+@lru_cache(maxsize=1)
+def _get_cross_encoder():
+    """Load the reranking cross-encoder once per process"""
+    return HuggingFaceCrossEncoder(
+        model_name="cross-encoder/ms-marco-MiniLM-L-4-v2",
+        model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"}
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_llm():
+    """One shared Groq client so every chain reuses the same keep-alive HTTP/2 connection.
+    Not streaming=True: .stream() streams anyway, and JSON mode can't stream."""
+    return ChatGroq(
+        **_LLM_KWARGS,
+        api_key=_GROQ_KEY,
+        http_client=httpx.Client(http2=True, limits=_HTTP_LIMITS)
+    )
+
+
+@asynccontextmanager
+async def _async_llm():
+    """Groq client for async calls with its own keep-alive HTTP/2 pool, closed
+    on exit (an async pool can't outlive the event loop that opened it)"""
+    async with httpx.AsyncClient(http2=True, limits=_HTTP_LIMITS) as http_async_client:
+        yield ChatGroq(
+            **_LLM_KWARGS,
+            api_key=_GROQ_KEY,
+            http_client=_get_llm().http_client,
+            http_async_client=http_async_client
+        )
+
+
+def _new_index(vectors: np.ndarray):
+    """Empty, trained ANN index sized to the paper. Long documents get IVF
+    (probe a few cells) over fp16 codes, very long ones over compact PQ
+    codes; short papers get HNSW over fp16 scalar-quantized vectors"""
+    n, dim = vectors.shape
+
+    if n >= IVF_MIN_VECTORS:
+        # ~sqrt(N) cells, but at least 39 training points per centroid
+        nlist = max(4, min(int(np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatIP(dim)
+        if n >= IVFPQ_MIN_VECTORS:
+            index = faiss.IndexIVFPQ(
+                quantizer, dim, nlist, IVFPQ_M, 8, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dim, nlist, faiss.ScalarQuantizer.QT_fp16,
+                faiss.METRIC_INNER_PRODUCT
+            )
+        # MMR search reconstructs vectors by id, which IVF needs a direct map for
+        index.set_direct_map_type(faiss.DirectMap.Array)
+        index.train(vectors)
+        return _tune_index(index)
+
+    index = faiss.IndexHNSWSQ(
+        dim, faiss.ScalarQuantizer.QT_fp16, HNSW_M, faiss.METRIC_INNER_PRODUCT
+    )
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    if not index.is_trained:
+        index.train(vectors)
+    return index
+
+
+def _tune_index(index):
+    """Apply query-time search parameters to a loaded index"""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    if hasattr(index, "nprobe"):
+        index.nprobe = min(index.nlist, max(4, index.nlist // 8))
+    return index
+
+
+def _distance_strategy(index):
+    """Score semantics matching the index metric (older indexes are L2)"""
+    if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+        return DistanceStrategy.MAX_INNER_PRODUCT
+    return DistanceStrategy.EUCLIDEAN_DISTANCE
+
+
+def _read_index(path: str):
+    """Read an index file. FAISS only honours IO_FLAG_MMAP for IVF inverted
+    lists, so IVF codes stay on disk until searches touch them; other
+    index types (HNSW-SQ) ignore the flag and are read into RAM as usual"""
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+@lru_cache(maxsize=1)
+def _get_gpu_resources():
+    """Shared FAISS GPU memory pool"""
+    return faiss.StandardGpuResources()
+
+
+def _maybe_to_gpu(index):
+    """Move a large index onto the GPU when enabled and supported (faiss-gpu)"""
+    if (
+        os.getenv("USE_GPU_INDEX") != "1"
+        or index.ntotal < GPU_INDEX_MIN_VECTORS
+        or not torch.cuda.is_available()
+        or not hasattr(faiss, "StandardGpuResources")
+    ):
+        return index
+
+    try:
+        return faiss.index_cpu_to_gpu(_get_gpu_resources(), 0, index)
+    except RuntimeError:
+        # Index types without a GPU implementation (e.g. HNSW) stay on CPU
+        return index
 
 
 def get_vectorstore_path(pdf_path: str) -> str:
@@ -32,67 +325,275 @@ def get_vectorstore_path(pdf_path: str) -> str:
     return os.path.join(VECTOR_DB_BASE, name)
 
 
+def iter_pdf_pages(pdf_path: str):
+    """Yield one Document per page, reusing the pages.jsonl cache next to
+    the vectorstore while the PDF's size and mtime are unchanged.
+    Pages are parsed lazily so callers can start work on early pages."""
+    stat = os.stat(pdf_path)
+    key = {"size": stat.st_size, "mtime": stat.st_mtime}
+    cache_path = Path(get_vectorstore_path(pdf_path)) / "pages.jsonl"
+
+    if cache_path.exists():
+        with open(cache_path, "rb") as f:
+            try:
+                header = orjson.loads(f.readline())
+            except orjson.JSONDecodeError:
+                # Empty or corrupt header: parse the PDF again
+                header = None
+            if header == key:
+                for line in f:
+                    yield Document(**orjson.loads(line))
+                return
+
+    # Written under a unique temporary name so a half-parsed PDF is never
+    # reused and two sessions parsing the same paper don't collide
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(key) + b"\n")
+            with pymupdf.open(pdf_path) as pdf:
+                for i, page in enumerate(pdf):
+                    doc = Document(
+                        page_content=page.get_text(),
+                        metadata={"source": str(pdf_path), "page": i}
+                    )
+                    record = {"page_content": doc.page_content, "metadata": doc.metadata}
+                    f.write(orjson.dumps(record) + b"\n")
+                    yield doc
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        # Interrupted or abandoned mid-parse: don't leave the partial file behind
+        os.unlink(tmp_path)
+        raise
+
+
+def iter_page_splits(pdf_path: str):
+    """Parse and split a PDF in one streaming pass, yielding
+    (parents, children) per page in page order. Only a few pages are in
+    flight on the split pool at a time, so the whole document's page text
+    is never held in memory at once."""
+    in_flight = deque()
+
+    for page in iter_pdf_pages(pdf_path):
+        in_flight.append(_SPLIT_POOL.submit(split_into_parents_and_children, [page]))
+        if len(in_flight) > SPLIT_WORKERS:
+            yield in_flight.popleft().result()
+
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
 def build_vectorstore_for_pdf(pdf_path: str):
     """Load, chunk, embed and save vectorstore for a single PDF"""
-    loader = PyPDFLoader(str(pdf_path))
-    docs = loader.load()
+    embeddings = _get_embeddings()
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
-    )
-    chunks = splitter.split_documents(docs)
+    vs_path = get_vectorstore_path(pdf_path)
+    os.makedirs(vs_path, exist_ok=True)
+
+    # Chunk vectors are kept under a hash of the embedder settings (model,
+    # backend, dtype) and every chunk text, so rebuilding the index (e.g. with
+    # new index parameters) skips the embedding pass, while any change to
+    # chunking or to the model misses the cache
+    digest = hashlib.sha256(repr((
+        embeddings.model_name, _embedding_model_kwargs(), embeddings.encode_kwargs
+    )).encode())
 
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
+    # If vectors were saved before they will probably match, so embedding
+    # waits until the hash is known instead of running while pages stream in
+    has_cache = any(Path(vs_path).glob("embeddings_*.npy"))
+
+    parents, chunks, pending, futures = [], [], [], []
+
+    def submit(batch):
+        texts = [chunk.page_content for chunk in batch]
+        futures.append(_EMBED_POOL.submit(embeddings.embed_documents, texts))
+
+    # Parse and split page by page, handing full batches to the embed thread
+    for page_parents, page_chunks in iter_page_splits(pdf_path):
+        parents.extend(page_parents)
+        chunks.extend(page_chunks)
+        for chunk in page_chunks:
+            digest.update(chunk.page_content.encode() + b"\0")
+
+        if not has_cache:
+            pending.extend(page_chunks)
+            if len(pending) >= EMBED_BATCH_SIZE:
+                submit(pending)
+                pending = []
+
+    texts = [chunk.page_content for chunk in chunks]
+    vectors_path = Path(vs_path) / f"embeddings_{digest.hexdigest()[:16]}.npy"
+
+    try:
+        vectors = np.load(vectors_path, mmap_mode="r")
+    except (OSError, ValueError, EOFError):
+        # Missing, or truncated by an interrupted save: embed again
+        vectors = None
+
+    if vectors is None:
+        if has_cache:
+            # The saved vectors are for other chunks or another model
+            pending = chunks
+        if pending:
+            submit(pending)
+        vectors = np.vstack([np.asarray(f.result(), dtype=np.float32) for f in futures])
+
+        for stale in Path(vs_path).glob("embeddings_*.npy"):
+            stale.unlink()
+
+        # Saved under a unique temporary name and swapped in, so a killed
+        # build never leaves a truncated file under the final name
+        fd, tmp_path = tempfile.mkstemp(dir=vs_path, suffix=".npy.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, vectors)
+        os.replace(tmp_path, vectors_path)
+
+    db = FAISS(
+        embedding_function=embeddings,
+        index=_new_index(vectors),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    db.add_embeddings(
+        list(zip(texts, vectors)),
+        metadatas=[chunk.metadata for chunk in chunks]
     )
+    # Parents live in the docstore only (not in the index), so they are
+    # saved alongside the index but never matched directly
+    db.docstore.add({parent.metadata["parent_id"]: parent for parent in parents})
 
-    db = FAISS.from_documents(chunks, embeddings)
-    vs_path = get_vectorstore_path(pdf_path)
-    os.makedirs(vs_path, exist_ok=True)
     db.save_local(vs_path)
+    db.index = _maybe_to_gpu(db.index)
+    _VECTORSTORES[vs_path] = db
+
+    # Context retrieved from a previous index of this paper is stale, and so
+    # are the questions generated from it
+    with _QUESTION_CONTEXT_LOCK:
+        for key in [key for key in _QUESTION_CONTEXT_CACHE if key[0] == vs_path]:
+            del _QUESTION_CONTEXT_CACHE[key]
+    _question_cache_path(pdf_path).unlink(missing_ok=True)
 
     return db
 
 
+def _init_build_worker(threads: int):
+    """Process-pool initializer: limit torch, ONNX Runtime and FAISS to this
+    worker's share of the cores so parallel builds don't oversubscribe the CPU"""
+    global _WORKER_THREADS
+    _WORKER_THREADS = threads
+    torch.set_num_threads(threads)
+    faiss.omp_set_num_threads(threads)
+
+
+def _build_vectorstore_worker(pdf_path: str) -> str:
+    """Process-pool entry point; returns the path instead of the (unpicklable) store"""
+    build_vectorstore_for_pdf(pdf_path)
+    return get_vectorstore_path(pdf_path)
+
+
+def build_all_vectorstores():
+    """Build vectorstores for every PDF that doesn't have one yet, one paper
+    per worker process (each worker loads its own embedding model once)"""
+    pdfs = [
+        str(p) for p in get_available_pdfs()
+        if not os.path.exists(os.path.join(get_vectorstore_path(p), "index.faiss"))
+    ]
+    if not pdfs:
+        return []
+
+    # On CUDA every worker would load MiniLM onto the same GPU, so use one
+    cpus = os.cpu_count() or 2
+    workers = 1 if torch.cuda.is_available() else min(len(pdfs), max(1, cpus // 2))
+
+    # spawn, not fork: forking a process that already holds torch threads can deadlock
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_build_worker,
+        initargs=(max(1, cpus // workers),)
+    ) as executor:
+        return list(executor.map(_build_vectorstore_worker, pdfs))
+
+
 def load_or_build_vectorstore(pdf_path: str):
     """Load existing vectorstore or build a new one for the given PDF"""
     vs_path = get_vectorstore_path(pdf_path)
 
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-MiniLM-L6-v2"
-    )
+    if vs_path in _VECTORSTORES:
+        return _VECTORSTORES[vs_path]
+
+    embeddings = _get_embeddings()
 
     if os.path.exists(vs_path) and os.path.exists(os.path.join(vs_path, "index.faiss")):
-        return FAISS.load_local(
-            vs_path,
-            embeddings,
-            allow_dangerous_deserialization=True
+        # Same files FAISS.load_local reads (index.faiss + index.pkl), but an
+        # IVF index is memory-mapped instead of copied into RAM
+        index = _read_index(os.path.join(vs_path, "index.faiss"))
+        with open(os.path.join(vs_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        db = FAISS(
+            embedding_function=embeddings,
+            index=_maybe_to_gpu(_tune_index(index)),
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=_distance_strategy(index)
         )
+        _VECTORSTORES[vs_path] = db
+        return db
     else:
         return build_vectorstore_for_pdf(pdf_path)
 
 
 # ── Main Chain ─────────────────────────────────────────────────────────────────
 
+class ParentSectionRetriever(BaseRetriever):
+    """Match the query against fine-grained child chunks and return the
+    parent sections they belong to (most relevant first, deduplicated)"""
+
+    vectorstore: FAISS
+    k: int = 4
+    fetch_k: int = 12
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        children = self.vectorstore.similarity_search(query, k=self.fetch_k)
+
+        results = []
+        seen = set()
+        for child in children:
+            parent_id = child.metadata.get("parent_id")
+            if parent_id is None:
+                # Vectorstore built before the parent/child split
+                results.append(child)
+            elif parent_id not in seen:
+                seen.add(parent_id)
+                parent = self.vectorstore.docstore.search(parent_id)
+                results.append(parent if isinstance(parent, Document) else child)
+
+            if len(results) == self.k:
+                break
+
+        return results
+
+
+@lru_cache(maxsize=32)
 def create_qa_chain(pdf_path: str):
-    """Create a retrieval QA chain for a specific PDF"""
+    """Create a retrieval QA chain for a specific PDF (memoized per path)"""
 
-    if not os.getenv("GROQ_API_KEY"):
+    if not _GROQ_KEY:
         raise ValueError("GROQ_API_KEY not found in .env file")
 
     vectorstore = load_or_build_vectorstore(pdf_path)
 
-    retriever = vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 4}
+    # Over-fetch 20 candidate sections, then keep the 4 the cross-encoder
+    # scores highest — same prompt size, better-targeted context
+    retriever = ContextualCompressionRetriever(
+        base_compressor=CrossEncoderReranker(model=_get_cross_encoder(), top_n=4),
+        base_retriever=ParentSectionRetriever(vectorstore=vectorstore, k=20, fetch_k=60)
     )
 
-    llm = ChatGroq(
-        model="llama-3.1-8b-instant",
-        temperature=0,
-        api_key=os.getenv("GROQ_API_KEY")
-    )
+    llm = _get_llm()
 
     prompt = ChatPromptTemplate.from_template("""
 You are a helpful academic assistant. Answer using ONLY the provided context.
@@ -115,136 +616,384 @@ Answer:
 
 # ── Question Generation ────────────────────────────────────────────────────────
 
-def generate_questions(qa_chain, q_type: str, count: int, topic: str = ""):
-    """Generate MCQ / Short Answer / Long Answer questions from loaded paper"""
+# Fixed per-type instructions and JSON schema. They go first, in the system
+# turn, and never change between calls, so the provider can reuse the cached
+# prompt prefix; count, topic and the retrieved context are appended last.
+MCQ_INSTRUCTIONS = """
+You are a helpful academic assistant. Use ONLY the provided context from the paper.
+Write multiple choice questions based on the academic paper content.
+
+IMPORTANT: Return ONLY a valid JSON object. No explanation, no markdown, no extra text.
+
+{
+  "questions": [
+    {
+      "question": "Question text here?",
+      "options": [
+        {"letter": "A", "text": "Option A text"},
+        {"letter": "B", "text": "Option B text"},
+        {"letter": "C", "text": "Option C text"},
+        {"letter": "D", "text": "Option D text"}
+      ],
+      "answer": "A"
+    }
+  ]
+}
+"""
 
-    topic_clause = f" Focus on the topic: {topic}." if topic.strip() else ""
+SHORT_ANSWER_INSTRUCTIONS = """
+You are a helpful academic assistant. Use ONLY the provided context from the paper.
+Write short answer questions based on the academic paper content.
+Each answer should be 2-3 sentences maximum.
 
-    if q_type == "MCQ":
-        prompt_text = f"""
-Based on the academic paper content, generate exactly {count} multiple choice questions.{topic_clause}
-
-IMPORTANT: Return ONLY a valid JSON array. No explanation, no markdown, no extra text.
-Start your response with [ and end with ]
-
-[
-  {{
-    "question": "Question text here?",
-    "options": [
-      {{"letter": "A", "text": "Option A text"}},
-      {{"letter": "B", "text": "Option B text"}},
-      {{"letter": "C", "text": "Option C text"}},
-      {{"letter": "D", "text": "Option D text"}}
-    ],
-    "answer": "A"
-  }}
-]
+IMPORTANT: Return ONLY a valid JSON object. No explanation, no markdown, no extra text.
 
-Generate {count} such question objects. Start with [ and end with ]. Nothing else.
+{
+  "questions": [
+    {
+      "question": "Question text here?",
+      "answer": "Short answer in 2-3 sentences."
+    }
+  ]
+}
 """
 
-    elif q_type == "Short Answer":
-        prompt_text = f"""
-Based on the academic paper content, generate exactly {count} short answer questions.{topic_clause}
-Each answer should be 2-3 sentences maximum.
-
-IMPORTANT: Return ONLY a valid JSON array. No explanation, no markdown, no extra text.
-Start your response with [ and end with ]
+LONG_ANSWER_INSTRUCTIONS = """
+You are a helpful academic assistant. Use ONLY the provided context from the paper.
+Write long answer questions based on the academic paper content.
+Each answer should be one detailed paragraph.
 
-[
-  {{
-    "question": "Question text here?",
-    "answer": "Short answer in 2-3 sentences."
-  }}
-]
+IMPORTANT: Return ONLY a valid JSON object. No explanation, no markdown, no extra text.
 
-Generate {count} such objects. Start with [ and end with ]. Nothing else.
+{
+  "questions": [
+    {
+      "question": "Detailed question text here?",
+      "answer": "Comprehensive paragraph answer here."
+    }
+  ]
+}
 """
 
-    else:  # Long Answer
-        prompt_text = f"""
-Based on the academic paper content, generate exactly {count} long answer questions.{topic_clause}
-Each answer should be one detailed paragraph.
+_QUESTION_INSTRUCTIONS = {
+    "MCQ": MCQ_INSTRUCTIONS,
+    "Short Answer": SHORT_ANSWER_INSTRUCTIONS,
+    "Long Answer": LONG_ANSWER_INSTRUCTIONS,
+}
 
-IMPORTANT: Return ONLY a valid JSON array. No explanation, no markdown, no extra text.
-Start your response with [ and end with ]
+_QUESTION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "{instructions}"),
+    ("human", "Context:\n{context}\n\n{request}")
+])
 
-[
-  {{
-    "question": "Detailed question text here?",
-    "answer": "Comprehensive paragraph answer here."
-  }}
-]
 
-Generate {count} such objects. Start with [ and end with ]. Nothing else.
-"""
+def _question_inputs(docs, q_type: str, count: int, topic: str) -> dict:
+    """Prompt variables: static instructions first, per-request details last"""
+    topic_clause = f" Focus on the topic: {topic}." if topic.strip() else ""
+    return {
+        "instructions": _QUESTION_INSTRUCTIONS.get(q_type, LONG_ANSWER_INSTRUCTIONS),
+        "context": "\n\n".join(doc.page_content for doc in docs),
+        "request": f'Generate exactly {count} such objects inside "questions".{topic_clause} Nothing else.'
+    }
+
+
+def _question_cache_path(pdf_path: str) -> Path:
+    """Per-paper response cache, cleared whenever the paper's index is rebuilt.
+    temperature=0, so a repeat request would return the same response."""
+    return Path(get_vectorstore_path(pdf_path)) / "questions_cache.json"
+
+
+def _question_cache_key(q_type: str, count: int, topic: str) -> str:
+    """Request parameters plus a hash of the model and the full prompt text,
+    so responses written for an older prompt are never served"""
+    topic = " ".join(topic.lower().split())
+    prompt = repr((
+        _get_llm().model_name,
+        _QUESTION_PROMPT.messages,
+        _question_inputs([], q_type, count, topic)
+    ))
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()[:16]
+    return f"{q_type}|{count}|{topic}|{prompt_hash}"
+
+
+def _read_question_cache(cache_path: Path) -> dict:
+    """Cached responses for one paper; a missing or corrupt file is an empty cache"""
+    try:
+        cache = orjson.loads(cache_path.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _store_question_response(cache_path: Path, cache_key: str, raw: str):
+    """Add one response to the cache file. It is rewritten under a unique
+    temporary name and swapped in, so concurrent writers never corrupt it."""
+    cache = _read_question_cache(cache_path)
+    cache[cache_key] = raw
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(orjson.dumps(cache))
+    os.replace(tmp_path, cache_path)
+
+
+def _question_retriever(pdf_path: str):
+    """Retrieve a broad, diverse slice of the paper (MMR) rather than
+    embedding the instruction prompt itself as the search query"""
+    return load_or_build_vectorstore(pdf_path).as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": 12, "fetch_k": 40}
+    )
+
+
+def _question_context(pdf_path: str, topic: str):
+    """Question-generation retrieval, memoized per paper and query (for the
+    most recent QUESTION_CONTEXT_CACHE_SIZE) so repeat generations skip the
+    query embedding and FAISS search"""
+    query = f"overview methodology results {topic}".strip()
+    key = (get_vectorstore_path(pdf_path), query)
+    with _QUESTION_CONTEXT_LOCK:
+        if key in _QUESTION_CONTEXT_CACHE:
+            _QUESTION_CONTEXT_CACHE.move_to_end(key)
+            return _QUESTION_CONTEXT_CACHE[key]
+
+    docs = _question_retriever(pdf_path).invoke(query)
+    with _QUESTION_CONTEXT_LOCK:
+        _QUESTION_CONTEXT_CACHE[key] = docs
+        if len(_QUESTION_CONTEXT_CACHE) > QUESTION_CONTEXT_CACHE_SIZE:
+            _QUESTION_CONTEXT_CACHE.popitem(last=False)
+    return docs
+
+
+def _question_chain(llm):
+    """Prompt + LLM in Groq JSON mode (guarantees a parseable object)"""
+    return _QUESTION_PROMPT | llm.bind(response_format={"type": "json_object"})
+
+
+def _cached_questions(pdf_path: str, q_type: str, count: int, topic: str):
+    """Look a request up in the paper's response cache.
+    Returns (cache_path, cache_key, questions or None on a miss)."""
+    if not _GROQ_KEY:
+        raise ValueError("GROQ_API_KEY not found in .env file")
+
+    cache_path = _question_cache_path(pdf_path)
+    cache_key = _question_cache_key(q_type, count, topic)
+    cached = _read_question_cache(cache_path).get(cache_key)
+    questions = _parse_questions(cached, q_type) if cached is not None else None
+    return cache_path, cache_key, questions
+
+
+def _finish_questions(cache_path: Path, cache_key: str, raw: str, q_type: str) -> list:
+    """Parse a fresh response. Only schema-valid responses are cached, so a
+    bad one can be retried."""
+    questions = _validate_questions(raw, q_type)
+    if questions is None:
+        return _parse_questions_safely(raw, q_type)
+
+    _store_question_response(cache_path, cache_key, raw)
+    return questions
+
+
+def generate_questions(pdf_path: str, q_type: str, count: int, topic: str = ""):
+    """Generate MCQ / Short Answer / Long Answer questions from loaded paper"""
+    cache_path, cache_key, questions = _cached_questions(pdf_path, q_type, count, topic)
+    if questions is not None:
+        return questions
+
+    docs = _question_context(pdf_path, topic)
+    result = _question_chain(_get_llm()).invoke(
+        _question_inputs(docs, q_type, count, topic)
+    )
+    return _finish_questions(cache_path, cache_key, result.content, q_type)
+
+
+async def generate_questions_async(pdf_path: str, q_type: str, count: int, topic: str = "", llm=None):
+    """Async variant of generate_questions, so several papers can wait on Groq at once.
+    Pass llm (from _async_llm) to share one connection pool across calls."""
+    cache_path, cache_key, questions = await asyncio.to_thread(
+        _cached_questions, pdf_path, q_type, count, topic
+    )
+    if questions is not None:
+        return questions
+
+    docs = await asyncio.to_thread(_question_context, pdf_path, topic)
+    async with (nullcontext(llm) if llm is not None else _async_llm()) as llm:
+        result = await _question_chain(llm).ainvoke(
+            _question_inputs(docs, q_type, count, topic)
+        )
+    return await asyncio.to_thread(
+        _finish_questions, cache_path, cache_key, result.content, q_type
+    )
+
+
+async def generate_questions_for_papers(pdf_paths, q_type: str, count: int, topic: str = ""):
+    """Generate the same kind of questions for several papers concurrently.
+    Returns one question list per path, in the order given."""
+
+    if not _GROQ_KEY:
+        raise ValueError("GROQ_API_KEY not found in .env file")
+
+    async with _async_llm() as llm:
+        return await asyncio.gather(*(
+            generate_questions_async(pdf_path, q_type, count, topic, llm=llm)
+            for pdf_path in pdf_paths
+        ))
+
 
-    result = qa_chain.invoke({"input": prompt_text})
-    raw = result.get("answer", "[]")
+# Response schemas for each question type, validated in one pydantic-core pass
+
+class MCQOption(BaseModel):
+    letter: str
+    text: str
+
+
+class MCQQuestion(BaseModel):
+    question: str
+    options: list[MCQOption]
+    answer: str
+
+
+class WrittenQuestion(BaseModel):
+    question: str
+    answer: str
+
+
+class MCQSet(BaseModel):
+    questions: list[MCQQuestion]
+
+
+class WrittenSet(BaseModel):
+    questions: list[WrittenQuestion]
+
+
+_QUESTION_SCHEMAS = {
+    "MCQ": MCQSet,
+    "Short Answer": WrittenSet,
+    "Long Answer": WrittenSet,
+}
+
+
+def _validate_questions(raw: str, q_type: str):
+    """Question dicts if raw matches the schema expected for q_type, else None"""
+    schema = _QUESTION_SCHEMAS.get(q_type)
+    if schema is None:
+        return None
+    try:
+        parsed = schema.model_validate_json(raw)
+    except ValidationError:
+        return None
+    return [q.model_dump() for q in parsed.questions] or None
+
+
+def _parse_questions(raw: str, q_type: str) -> list:
+    """
+    Parse a JSON-mode response against the schema expected for q_type.
+    Falls back to _parse_questions_safely if it doesn't match.
+    """
+    questions = _validate_questions(raw, q_type)
+    if questions is not None:
+        return questions
 
     return _parse_questions_safely(raw, q_type)
 
 
+# Patterns used by _parse_questions_safely, compiled once at import
+_RE_Q     = re.compile(r'^(?:\d+[\.\)]|Q\d*[\.\):])\s*(.+)')
+_RE_A     = re.compile(r'^(?:A(?:ns(?:wer)?)?[\.\):])\s*(.+)', re.IGNORECASE)
+
+
+def _iter_balanced(text: str, opener: str, closer: str):
+    """
+    Yield (depth, slice) for every balanced opener ... closer span of text
+    (inner spans first, depth 0 = not nested) in a single linear pass,
+    ignoring brackets that appear inside JSON strings. Quotes are only
+    tracked inside an open span, so a stray quote in prose before the
+    JSON can't hide the brackets after it.
+    """
+    starts = []
+    in_string = False
+    escaped = False
+
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and starts:
+            in_string = True
+        elif char == opener:
+            starts.append(i)
+        elif char == closer and starts:
+            start = starts.pop()
+            yield len(starts), text[start:i + 1]
+
+
+def _is_question_list(parsed) -> bool:
+    """True for a non-empty list of question objects (rules out "[1]" or a bare options list)"""
+    return (
+        isinstance(parsed, list)
+        and len(parsed) > 0
+        and all(isinstance(q, dict) and "question" in q for q in parsed)
+    )
+
+
 def _parse_questions_safely(raw: str, q_type: str) -> list:
     """
     Robustly parse LLM output into a list of question dicts.
-    Tries 6 strategies before giving up.
+    Tries 5 strategies before giving up.
     """
 
-    # Strategy 1: Strip markdown fences and try direct parse
-    clean = re.sub(r"```(?:json)?", "", raw).replace("```", "").strip()
-    try:
-        parsed = json.loads(clean)
-        if isinstance(parsed, list) and len(parsed) > 0:
-            return parsed
-    except json.JSONDecodeError:
-        pass
-
-    # Strategy 2: Extract JSON array with regex (handles extra text before/after)
-    match = re.search(r'\[.*?\]', clean, re.DOTALL)
-    if match:
+    # Strategy 1: Strip markdown fences and parse the outermost [ ... ]
+    # (covers a clean response as well as stray text before/after the array)
+    clean = raw.replace("```json", "").replace("```", "").strip()
+    start = clean.find('[')
+    end   = clean.rfind(']')
+    if start != -1 and end > start:
         try:
-            parsed = json.loads(match.group())
-            if isinstance(parsed, list) and len(parsed) > 0:
+            parsed = orjson.loads(clean[start:end + 1])
+            if _is_question_list(parsed):
                 return parsed
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             pass
 
+    # Strategy 2: Try each complete top-level [ ... ] on its own
+    # (handles trailing junk after the array or stray brackets like "[1]")
+    for depth, array_text in _iter_balanced(clean, "[", "]"):
+        if depth > 0:
+            continue
+        try:
+            parsed = orjson.loads(array_text)
+            if _is_question_list(parsed):
+                return parsed
+        except orjson.JSONDecodeError:
+            continue
+
     # Strategy 3: Fix common JSON issues — unescaped smart/curly quotes
     try:
         fixed = clean.replace('\u201c', '"').replace('\u201d', '"')
         fixed = fixed.replace('\u2018', "'").replace('\u2019', "'")
-        parsed = json.loads(fixed)
-        if isinstance(parsed, list) and len(parsed) > 0:
+        parsed = orjson.loads(fixed)
+        if _is_question_list(parsed):
             return parsed
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         pass
 
-    # Strategy 4: Find the outermost [ ... ] even if nested content is messy
-    start = clean.find('[')
-    end   = clean.rfind(']')
-    if start != -1 and end != -1 and end > start:
-        try:
-            parsed = json.loads(clean[start:end + 1])
-            if isinstance(parsed, list) and len(parsed) > 0:
-                return parsed
-        except json.JSONDecodeError:
-            pass
-
-    # Strategy 5: Extract individual {...} objects one by one
+    # Strategy 4: Extract individual {...} objects one by one
     questions = []
-    for obj_match in re.finditer(r'\{[^{}]*\}', clean, re.DOTALL):
+    for _, obj_text in _iter_balanced(clean, "{", "}"):
         try:
-            obj = json.loads(obj_match.group())
+            obj = orjson.loads(obj_text)
             if 'question' in obj:
                 questions.append(obj)
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             continue
 
     if questions:
         return questions
 
-    # Strategy 6: Plain text fallback — extract Q&A pairs from raw text
+    # Strategy 5: Plain text fallback — extract Q&A pairs from raw text
     # Handles cases where model ignores JSON instruction entirely
     questions = []
     lines = raw.strip().split('\n')
@@ -257,9 +1006,9 @@ def _parse_questions_safely(raw: str, q_type: str) -> list:
             continue
 
         # Detect question lines — numbered (1. / 1) ) or Q: prefix
-        q_match = re.match(r'^(?:\d+[\.\)]|Q\d*[\.\):])\s*(.+)', line)
+        q_match = _RE_Q.match(line)
         # Detect answer lines — A: / Ans: / Answer: prefix
-        a_match = re.match(r'^(?:A(?:ns(?:wer)?)?[\.\):])\s*(.+)', line, re.IGNORECASE)
+        a_match = _RE_A.match(line)
 
         if q_match:
             if current_q and current_a: